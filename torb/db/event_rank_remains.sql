@@ -0,0 +1,10 @@
+INSERT INTO event_rank_remains (event_id, `rank`, remains)
+SELECT e.id, s.`rank`, COUNT(*) - COUNT(r.sheet_id)
+FROM events e
+CROSS JOIN sheets s
+LEFT JOIN (
+    SELECT DISTINCT event_id, sheet_id
+    FROM reservations
+    WHERE canceled_at IS NULL
+) r ON r.event_id = e.id AND r.sheet_id = s.id
+GROUP BY e.id, s.`rank`;
@@ -16,3 +16,4 @@ if [ ! -f "$DB_DIR/isucon8q-initial-dataset.sql.gz" ]; then
 fi
 
 gzip -dc "$DB_DIR/isucon8q-initial-dataset.sql.gz" | mysql -uisucon torb
+mysql -uisucon torb < "$DB_DIR/event_rank_remains.sql"
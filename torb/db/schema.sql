@@ -32,6 +32,13 @@ CREATE TABLE IF NOT EXISTS reservations (
     KEY event_id_and_sheet_id_idx (event_id, sheet_id)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
 
+CREATE TABLE IF NOT EXISTS event_rank_remains (
+    event_id    INTEGER UNSIGNED NOT NULL,
+    `rank`      VARCHAR(128)     NOT NULL,
+    remains     INTEGER          NOT NULL,
+    PRIMARY KEY (event_id, `rank`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
 CREATE TABLE IF NOT EXISTS administrators (
     id          INTEGER UNSIGNED PRIMARY KEY AUTO_INCREMENT,
     nickname    VARCHAR(128) NOT NULL,
@@ -4,3 +4,5 @@ DB_HOST=isucon2
 DB_PORT=3306
 DB_USER=isucon
 DB_PASS=isucon
+# group commit of reservation writes (needs threaded workers, e.g. gunicorn --threads)
+# RESERVATION_BATCH_WINDOW_MS=2
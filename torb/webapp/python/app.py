@@ -1,18 +1,21 @@
+import time
+_import_started_at = time.perf_counter()
+
 import MySQLdb
 import MySQLdb.cursors
 import flask
 import functools
 import os
 import pathlib
-import copy
-import json
 import random
 import subprocess
 import itertools
 from io import StringIO
 import csv
-from datetime import datetime, timezone
-import hashlib
+import timeutil
+import credentials
+import batcher
+import eventdetail
 
 
 base_path = pathlib.Path(__file__).resolve().parent.parent
@@ -46,11 +49,11 @@ def make_base_url(request):
 
 @app.template_filter('tojsonsafe')
 def tojsonsafe(target):
-    return json.dumps(target).replace("+", "\\u002b").replace("<", "\\u003c").replace(">", "\\u003e")
+    return eventdetail.dumps(target).replace("+", "\\u002b").replace("<", "\\u003c").replace(">", "\\u003e")
 
 
 def jsonify(target):
-    return json.dumps(target)
+    return eventdetail.dumps(target)
 
 
 def res_error(error="unknown", status=500):
@@ -75,10 +78,8 @@ def admin_login_required(f):
     return wrapper
 
 
-def dbh():
-    if hasattr(flask.g, 'db'):
-        return flask.g.db
-    flask.g.db = MySQLdb.connect(
+def connect():
+    conn = MySQLdb.connect(
         host=os.environ['DB_HOST'],
         port=3306,
         user=os.environ['DB_USER'],
@@ -88,11 +89,26 @@ def dbh():
         cursorclass=MySQLdb.cursors.DictCursor,
         autocommit=True,
     )
-    cur = flask.g.db.cursor()
+    cur = conn.cursor()
     cur.execute("SET SESSION sql_mode='STRICT_TRANS_TABLES,NO_ZERO_IN_DATE,NO_ZERO_DATE,ERROR_FOR_DIVISION_BY_ZERO,NO_ENGINE_SUBSTITUTION'")
+    return conn
+
+
+def dbh():
+    if hasattr(flask.g, 'db'):
+        return flask.g.db
+    flask.g.db = connect()
     return flask.g.db
 
 
+# RESERVATION_BATCH_WINDOW_MS > 0 turns on group commit of reservation writes
+reservation_batch_window_ms = float(os.environ.get('RESERVATION_BATCH_WINDOW_MS', '0'))
+if reservation_batch_window_ms > 0:
+    reservation_batcher = batcher.ReservationBatcher(connect, window=reservation_batch_window_ms / 1000)
+else:
+    reservation_batcher = None
+
+
 @app.teardown_appcontext
 def teardown(error):
     if hasattr(flask.g, "db"):
@@ -114,6 +130,17 @@ def sheets():
     return _sheets
 
 
+_sheet_catalog = None
+
+def sheet_catalog():
+    global _sheet_catalog
+    if _sheet_catalog:
+        return _sheet_catalog
+
+    _sheet_catalog = eventdetail.SheetCatalog(sheets())
+    return _sheet_catalog
+
+
 def calculate_rank(sheet_id):
     """
     case
@@ -152,6 +179,34 @@ def event_exist_and_public(event_id):
     return bool(event['public_fg'])
 
 
+def get_rank_remains(event_id, rank):
+    """
+    remaining seats of a public event's rank, or None if the event is not
+    public, does not exist or the rank is invalid
+    """
+    cur = dbh().cursor()
+    cur.execute("""
+        SELECT c.remains
+        FROM event_rank_remains c
+        INNER JOIN events e ON e.id = c.event_id
+        WHERE
+            c.event_id = %s
+            AND c.`rank` = %s
+            AND e.public_fg = 1
+        """,
+        [event_id, rank])
+    row = cur.fetchone()
+    if not row:
+        return None
+    return row['remains']
+
+
+def update_rank_remains(cur, event_id, rank, delta):
+    cur.execute(
+        "UPDATE event_rank_remains SET remains = remains + %s WHERE event_id = %s AND `rank` = %s",
+        [delta, event_id, rank])
+
+
 def get_events(only_public=False):
     conn = dbh()
     conn.autocommit(False)
@@ -185,41 +240,35 @@ def get_event(event_id, login_user_id=None, with_detail=True):
         rank_info = {
             'total': rank_count[rank], 'remains': rank_count[rank], 'detail': [], 'price': event['price'] + rank_price[rank]
         }
-        if with_detail:
-            rank_info['detail'] = []
         event["sheets"][rank] = rank_info
 
+    if with_detail:
+        seats = eventdetail.EventSeats(sheet_catalog(), login_user_id)
+        for rank in rank_price:
+            event["sheets"][rank]['detail'] = seats.rank_detail(rank)
+
     cur.execute("""
-    select r.sheet_id, r.user_id, r.reserved_at
+    select r.sheet_id, r.user_id, """ + timeutil.usec_column('r.reserved_at', 'reserved_at_usec') + """
     from reservations r
     where
         r.canceled_at is null
         and r.event_id = %s
     group by 1
-    having r.reserved_at = min(r.reserved_at)
+    having reserved_at_usec = min(""" + timeutil.usec_expr('r.reserved_at') + """)
     order by 1
     """, [event_id])
     reserved_sheets = cur.fetchall()
 
     event['remains'] = rank_total
 
-    if with_detail:
-        for sheet in sheets():
-            event['sheets'][sheet['rank']]['detail'].append(copy.copy(sheet))
-
     for reserved_sheet in reserved_sheets:
         sheet_id = reserved_sheet['sheet_id']
-        sheet_index = sheet_id - 1
-        sheet_num_index = sheets()[sheet_index]['num'] - 1
         rank = calculate_rank(sheet_id)
         event['sheets'][rank]['remains'] -= 1
         event['remains'] -= 1
 
         if with_detail:
-            if login_user_id and reserved_sheet['user_id'] == login_user_id:
-                event['sheets'][rank]['detail'][sheet_num_index]['mine'] = True
-            event['sheets'][rank]['detail'][sheet_num_index]['reserved'] = True
-            event['sheets'][rank]['detail'][sheet_num_index]['reserved_at'] = int(reserved_sheet['reserved_at'].replace(tzinfo=timezone.utc).timestamp())
+            seats.reserve(sheet_id, reserved_sheet['user_id'], timeutil.to_epoch(reserved_sheet['reserved_at_usec']))
 
     event['public'] = True if event['public_fg'] else False
     event['closed'] = True if event['closed_fg'] else False
@@ -228,7 +277,7 @@ def get_event(event_id, login_user_id=None, with_detail=True):
     return event
 
 def sanitize_event(event):
-    sanitized = copy.copy(event)
+    sanitized = dict(event)
     del sanitized['price']
     del sanitized['public']
     del sanitized['closed']
@@ -299,6 +348,7 @@ def get_index():
 @app.route('/initialize')
 def get_initialize():
     subprocess.call(["../../db/init.sh"])
+    credentials.clear()
     return ('', 204)
 
 
@@ -313,8 +363,8 @@ def post_users():
     cur = conn.cursor()
     try:
         cur.execute(
-            "INSERT INTO users (login_name, pass_hash, nickname) VALUES (%s, SHA2(%s, 256), %s)",
-            [login_name, password, nickname])
+            "INSERT INTO users (login_name, pass_hash, nickname) VALUES (%s, %s, %s)",
+            [login_name, credentials.hash_password(password), nickname])
         user_id = cur.lastrowid
         conn.commit()
     except MySQLdb.IntegrityError as e:
@@ -340,7 +390,9 @@ def get_users(user_id):
         return ('', 403)
 
     cur.execute("""
-        SELECT r.*,
+        SELECT r.id, r.event_id, r.sheet_id,
+               """ + timeutil.usec_column('r.reserved_at', 'reserved_at_usec') + """,
+               """ + timeutil.usec_column('r.canceled_at', 'canceled_at_usec') + """,
                e.title AS title, e.price AS price,
                e.public_fg AS public_fg, e.closed_fg AS closed_fg
         FROM reservations r
@@ -364,8 +416,8 @@ def get_users(user_id):
             'closed': True if row['closed_fg'] else False,
         }
 
-        if row['canceled_at']:
-            canceled_at = int(row['canceled_at'].replace(tzinfo=timezone.utc).timestamp())
+        if row['canceled_at_usec'] is not None:
+            canceled_at = timeutil.to_epoch(row['canceled_at_usec'])
         else:
             canceled_at = None
 
@@ -377,7 +429,7 @@ def get_users(user_id):
             "sheet_rank": rank,
             "sheet_num": int(sheet_num),
             "price": int(price),
-            "reserved_at": int(row['reserved_at'].replace(tzinfo=timezone.utc).timestamp()),
+            "reserved_at": timeutil.to_epoch(row['reserved_at_usec']),
             "canceled_at": canceled_at,
         })
 
@@ -418,17 +470,12 @@ def post_login():
     login_name = flask.request.json['login_name']
     password = flask.request.json['password']
 
-    cur = dbh().cursor()
-
-    cur.execute('SELECT * FROM users WHERE login_name = %s', [login_name])
-    user = cur.fetchone()
-    pass_hash = hashlib.sha256(password.encode('utf-8')).hexdigest()
-    if not user or pass_hash != user['pass_hash']:
+    user = credentials.verify_user(dbh, login_name, password)
+    if not user:
         return res_error("authentication_failed", 401)
 
     flask.session['user_id'] = user["id"]
-    user = get_login_user()
-    return flask.jsonify(user)
+    return flask.jsonify({"id": user["id"], "nickname": user["nickname"]})
 
 
 @app.route('/api/actions/logout', methods=['POST'])
@@ -462,12 +509,21 @@ def get_events_by_id(event_id):
 def post_reserve(event_id):
     rank = flask.request.json["sheet_rank"]
 
+    remains = get_rank_remains(event_id, rank)
+    if remains is not None and remains <= 0:
+        return res_error("sold_out", 409)
+
     user = get_login_user()
 
-    if not event_exist_and_public(event_id):
-        return res_error("invalid_event", 404)
-    if not validate_rank(rank):
-        return res_error("invalid_rank", 400)
+    # a counter row already proves the event is public and the rank valid
+    if remains is None:
+        if not event_exist_and_public(event_id):
+            return res_error("invalid_event", 404)
+        if not validate_rank(rank):
+            return res_error("invalid_rank", 400)
+
+    if reservation_batcher:
+        return post_reserve_batched(event_id, rank, user['id'])
 
     sheet = None
     reservation_id = 0
@@ -507,8 +563,9 @@ def post_reserve(event_id):
         cur = conn.cursor()
         cur.execute(
             "INSERT INTO reservations (event_id, sheet_id, user_id, reserved_at) VALUES (%s, %s, %s, %s)",
-            [event_id, sheet['id'], user['id'], datetime.utcnow().strftime("%F %T.%f")])
+            [event_id, sheet['id'], user['id'], timeutil.to_sql(timeutil.now_usec())])
         reservation_id = cur.lastrowid
+        update_rank_remains(cur, event_id, rank, -1)
         conn.commit()
     except MySQLdb.Error as e:
         conn.rollback()
@@ -522,6 +579,46 @@ def post_reserve(event_id):
         "sheet_num": sheet['num']})
     return flask.Response(content, status=202, mimetype='application/json')
 
+
+def post_reserve_batched(event_id, rank, user_id):
+    cur = dbh().cursor()
+    while True:
+        cur.execute("""
+            SELECT id, num FROM sheets
+            WHERE
+                id NOT IN (
+                    SELECT sheet_id
+                    FROM reservations
+                    WHERE
+                        event_id = %s
+                        AND canceled_at IS NULL
+                )
+                AND `rank` = %s
+            """,
+            [event_id, rank])
+        candidates = list(cur.fetchall())
+        if not candidates:
+            return res_error("sold_out", 409)
+        random.shuffle(candidates)
+        # the batcher takes the first candidate still free when it flushes;
+        # None means all of them were taken meanwhile, so look again
+        try:
+            reserved = reservation_batcher.reserve(
+                event_id, [sheet['id'] for sheet in candidates], rank, user_id,
+                timeutil.to_sql(timeutil.now_usec()))
+        except Exception as e:
+            print(e)
+            return res_error()
+        if reserved:
+            reservation_id, sheet_id = reserved
+            sheet_num = next(sheet['num'] for sheet in candidates if sheet['id'] == sheet_id)
+            content = jsonify({
+                "id": reservation_id,
+                "sheet_rank": rank,
+                "sheet_num": sheet_num})
+            return flask.Response(content, status=202, mimetype='application/json')
+
+
 def calculate_sheet_id(rank, num):
     if rank == 'S':
         return num
@@ -547,6 +644,18 @@ def delete_reserve(event_id, rank, num):
 
     sheet_id = calculate_sheet_id(rank, num)
 
+    if reservation_batcher:
+        try:
+            error = reservation_batcher.cancel(event_id, sheet_id, rank, user_id, timeutil.to_sql(timeutil.now_usec()))
+        except Exception as e:
+            print(e)
+            return res_error()
+        if error == 'not_reserved':
+            return res_error("not_reserved", 400)
+        if error == 'not_permitted':
+            return res_error("not_permitted", 403)
+        return flask.Response(status=204)
+
     for i in range(3):
         try:
             conn = dbh()
@@ -575,7 +684,8 @@ def delete_reserve(event_id, rank, num):
 
             cur.execute(
                 "UPDATE reservations SET canceled_at = %s WHERE id = %s",
-                [datetime.utcnow().strftime("%F %T.%f"), reservation['id']])
+                [timeutil.to_sql(timeutil.now_usec()), reservation['id']])
+            update_rank_remains(cur, event_id, rank, 1)
             conn.commit()
             break
         except MySQLdb.Error as e:
@@ -603,12 +713,8 @@ def post_adin_login():
     login_name = flask.request.json['login_name']
     password = flask.request.json['password']
 
-    cur = dbh().cursor()
-
-    cur.execute('SELECT *, SHA2(%s, 256) as input_password FROM administrators WHERE login_name = %s', [password, login_name])
-    administrator = cur.fetchone()
-
-    if not administrator or not administrator['pass_hash'] == administrator['input_password']:
+    administrator = credentials.verify_administrator(dbh, login_name, password)
+    if not administrator:
         return res_error("authentication_failed", 401)
 
     flask.session['administrator_id'] = administrator['id']
@@ -643,6 +749,9 @@ def post_admin_events_api():
             "INSERT INTO events (title, public_fg, closed_fg, price) VALUES (%s, %s, 0, %s)",
             [title, public, price])
         event_id = cur.lastrowid
+        cur.executemany(
+            "INSERT INTO event_rank_remains (event_id, `rank`, remains) VALUES (%s, %s, %s)",
+            [[event_id, rank, rank_count[rank]] for rank in rank_count])
         conn.commit()
     except MySQLdb.Error as e:
         conn.rollback()
@@ -700,7 +809,10 @@ def get_admin_event_sales(event_id):
             cur.execute('select price from events where id = %s', [event_id])
             event_price = cur.fetchone()['price']
             reservations = cur.execute('''
-                SELECT r.*, %s AS event_price
+                SELECT r.id, r.sheet_id, r.user_id,
+                       ''' + timeutil.usec_column('r.reserved_at', 'reserved_at_usec') + ''',
+                       ''' + timeutil.usec_column('r.canceled_at', 'canceled_at_usec') + ''',
+                       %s AS event_price
                 FROM reservations r
                 WHERE
                     r.event_id = %s
@@ -715,8 +827,8 @@ def get_admin_event_sales(event_id):
     reports = []
 
     for reservation in reservations:
-        if reservation['canceled_at']:
-            canceled_at = reservation['canceled_at'].isoformat()+"Z"
+        if reservation['canceled_at_usec'] is not None:
+            canceled_at = timeutil.to_iso(reservation['canceled_at_usec'])
         else: canceled_at = ''
         rank = calculate_rank(reservation['sheet_id'])
         sheet_idx = reservation['sheet_id'] - 1
@@ -726,7 +838,7 @@ def get_admin_event_sales(event_id):
             "rank":           rank,
             "num":            sheets()[sheet_idx]['num'],
             "user_id":        reservation['user_id'],
-            "sold_at":        reservation['reserved_at'].isoformat()+"Z",
+            "sold_at":        timeutil.to_iso(reservation['reserved_at_usec']),
             "canceled_at":    canceled_at,
             "price":          reservation['event_price'] + sheets()[sheet_idx]['price'],
         })
@@ -740,7 +852,9 @@ def get_admin_sales():
     cur = dbh().cursor()
     reservations = cur.execute('''
         SELECT
-            r.*,
+            r.id, r.sheet_id, r.user_id,
+            ''' + timeutil.usec_column('r.reserved_at', 'reserved_at_usec') + ''',
+            ''' + timeutil.usec_column('r.canceled_at', 'canceled_at_usec') + ''',
             e.id AS event_id, e.price AS event_price
         FROM reservations r
         INNER JOIN events e
@@ -751,8 +865,8 @@ def get_admin_sales():
 
     def make_reports():
         for reservation in reservations:
-            if reservation['canceled_at']:
-                canceled_at = reservation['canceled_at'].isoformat()+"Z"
+            if reservation['canceled_at_usec'] is not None:
+                canceled_at = timeutil.to_iso(reservation['canceled_at_usec'])
             else: canceled_at = ''
             rank = calculate_rank(reservation['sheet_id'])
             sheet_idx = reservation['sheet_id'] - 1
@@ -762,14 +876,38 @@ def get_admin_sales():
                 "rank":           rank,
                 "num":            sheets()[sheet_idx]['num'],
                 "user_id":        reservation['user_id'],
-                "sold_at":        reservation['reserved_at'].isoformat()+"Z",
+                "sold_at":        timeutil.to_iso(reservation['reserved_at_usec']),
                 "canceled_at":    canceled_at,
                 "price":          reservation['event_price'] + sheets()[sheet_idx]['price'],
             }
     return render_report_csv(make_reports())
 
 
+def warm_up():
+    """
+    preload the sheet catalog and templates before the worker accepts traffic
+
+    best-effort: a failing step is only logged and left to lazy loading on
+    the first request (the DB may not be up yet, see restart-all.sh)
+    """
+    started_at = time.perf_counter()
+    try:
+        with app.app_context():
+            sheet_catalog()
+    except Exception as e:
+        print(e)
+    for template in ('index.html', 'admin.html'):
+        try:
+            app.jinja_env.get_template(template)
+        except Exception as e:
+            print(e)
+    finished_at = time.perf_counter()
+    print("cold start: load {:.1f} ms, warm-up {:.1f} ms".format(
+        (started_at - _import_started_at) * 1000, (finished_at - started_at) * 1000))
+
+
 if __name__ == "__main__":
+    warm_up()
     import bjoern
     bjoern.run(app, "0.0.0.0", 8080)
     # app.run(port=8080, debug=True, threaded=True)
@@ -0,0 +1,189 @@
+"""
+Write-behind group commit for reservation inserts and cancels.
+
+Requests hand their write to ReservationBatcher and block on a Future.
+A single background thread per process collects writes for `window`
+seconds and applies them in one transaction:
+
+- active reservations for every touched seat are locked with FOR UPDATE
+- cancels are checked against them and applied with one UPDATE
+- each insert takes the first of its candidate seats that is neither
+  reserved in the DB nor taken earlier in the same batch (None if there
+  is none); all of them go into one multi-row INSERT
+- event_rank_remains is adjusted once per (event, rank)
+
+Ids of a multi-row INSERT are lastrowid, lastrowid + 1, ..., which holds
+with innodb_autoinc_lock_mode <= 1 (see my.cnf).
+"""
+import collections
+import concurrent.futures
+import queue
+import threading
+import time
+
+import MySQLdb
+
+
+Reserve = collections.namedtuple('Reserve', ['event_id', 'sheet_ids', 'rank', 'user_id', 'reserved_at', 'future'])
+Cancel = collections.namedtuple('Cancel', ['event_id', 'sheet_id', 'rank', 'user_id', 'canceled_at', 'future'])
+
+
+class ReservationBatcher:
+
+    def __init__(self, connect, window=0.002, max_batch=256):
+        self.connect = connect
+        self.window = window
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._conn = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def reserve(self, event_id, sheet_ids, rank, user_id, reserved_at):
+        """
+        reserves the first free seat of sheet_ids and returns
+        (reservation id, sheet id), or None if all of them are taken
+        """
+        future = concurrent.futures.Future()
+        self._submit(Reserve(event_id, sheet_ids, rank, user_id, reserved_at, future))
+        return future.result()
+
+    def cancel(self, event_id, sheet_id, rank, user_id, canceled_at):
+        """returns None on success, otherwise 'not_reserved' or 'not_permitted'"""
+        future = concurrent.futures.Future()
+        self._submit(Cancel(event_id, sheet_id, rank, user_id, canceled_at, future))
+        return future.result()
+
+    def _submit(self, op):
+        # started lazily so that each forked worker gets its own thread
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, daemon=True)
+                    self._thread.start()
+        self._queue.put(op)
+
+    def _run(self):
+        while True:
+            ops = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(ops) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    ops.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                results = self._flush(ops)
+            except Exception as e:
+                for op in ops:
+                    op.future.set_exception(e)
+                continue
+            for op, result in zip(ops, results):
+                op.future.set_result(result)
+
+    def _flush(self, ops):
+        for i in range(3):
+            try:
+                if self._conn is None:
+                    self._conn = self.connect()
+                    self._conn.autocommit(False)
+                results = self._apply(self._conn.cursor(), ops)
+                self._conn.commit()
+                return results
+            except MySQLdb.Error as e:
+                print(e)
+                self._rollback()
+                if i == 2:
+                    raise e
+            except Exception:
+                # never leave a half-applied batch for the next commit
+                self._rollback()
+                raise
+
+    def _rollback(self):
+        if self._conn is None:
+            return
+        try:
+            self._conn.rollback()
+        except Exception:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+
+    def _apply(self, cur, ops):
+        seats_by_event = collections.defaultdict(set)
+        for op in ops:
+            if isinstance(op, Reserve):
+                seats_by_event[op.event_id].update(op.sheet_ids)
+            else:
+                seats_by_event[op.event_id].add(op.sheet_id)
+
+        active = {}
+        for event_id, sheet_ids in seats_by_event.items():
+            cur.execute(
+                "SELECT id, sheet_id, user_id FROM reservations"
+                " WHERE event_id = %s AND sheet_id IN ({}) AND canceled_at IS NULL"
+                " ORDER BY reserved_at FOR UPDATE".format(', '.join(['%s'] * len(sheet_ids))),
+                [event_id] + sorted(sheet_ids))
+            for row in cur.fetchall():
+                active.setdefault((event_id, row['sheet_id']), row)
+
+        results = [None] * len(ops)
+        remains_delta = collections.Counter()
+
+        canceled = []
+        for i, op in enumerate(ops):
+            if not isinstance(op, Cancel):
+                continue
+            reservation = active.get((op.event_id, op.sheet_id))
+            if not reservation:
+                results[i] = 'not_reserved'
+            elif reservation['user_id'] != op.user_id:
+                results[i] = 'not_permitted'
+            else:
+                del active[(op.event_id, op.sheet_id)]
+                canceled.append((reservation['id'], op.canceled_at))
+                remains_delta[(op.event_id, op.rank)] += 1
+        if canceled:
+            params = []
+            for reservation_id, canceled_at in canceled:
+                params.extend([reservation_id, canceled_at])
+            params.extend(reservation_id for reservation_id, _ in canceled)
+            cur.execute(
+                "UPDATE reservations SET canceled_at = CASE id {} END WHERE id IN ({})".format(
+                    ' '.join(['WHEN %s THEN %s'] * len(canceled)), ', '.join(['%s'] * len(canceled))),
+                params)
+
+        inserts = []
+        for i, op in enumerate(ops):
+            if not isinstance(op, Reserve):
+                continue
+            for sheet_id in op.sheet_ids:
+                if (op.event_id, sheet_id) not in active:
+                    active[(op.event_id, sheet_id)] = op
+                    inserts.append((i, sheet_id))
+                    remains_delta[(op.event_id, op.rank)] -= 1
+                    break
+        if inserts:
+            values = []
+            for i, sheet_id in inserts:
+                values.extend([ops[i].event_id, sheet_id, ops[i].user_id, ops[i].reserved_at])
+            cur.execute(
+                "INSERT INTO reservations (event_id, sheet_id, user_id, reserved_at) VALUES {}".format(
+                    ', '.join(['(%s, %s, %s, %s)'] * len(inserts))),
+                values)
+            for n, (i, sheet_id) in enumerate(inserts):
+                results[i] = (cur.lastrowid + n, sheet_id)
+
+        for (event_id, rank), delta in sorted(remains_delta.items()):
+            if delta:
+                cur.execute(
+                    "UPDATE event_rank_remains SET remains = remains + %s WHERE event_id = %s AND `rank` = %s",
+                    [delta, event_id, rank])
+
+        return results
@@ -0,0 +1,94 @@
+"""
+Memory benchmark for the event detail representation (eventdetail) against
+the per-sheet dicts get_event used to build.
+
+    python3 -m bench.event_detail
+"""
+import copy
+import json
+import random
+import time
+import tracemalloc
+
+import eventdetail
+
+RANKS = [('S', 50, 5000), ('A', 150, 3000), ('B', 300, 1000), ('C', 500, 0)]
+LOGIN_USER_ID = 7
+
+
+def make_sheets():
+    sheets = []
+    for rank, count, price in RANKS:
+        for num in range(1, count + 1):
+            sheets.append({'id': len(sheets) + 1, 'rank': rank, 'num': num, 'price': price})
+    return sheets
+
+
+def make_reserved(sheets, ratio):
+    rng = random.Random(0)
+    reserved = []
+    for sheet in sheets:
+        if rng.random() < ratio:
+            reserved.append({
+                'sheet_id': sheet['id'],
+                'user_id': rng.choice([LOGIN_USER_ID, 1, 2, 3]),
+                'reserved_at': 1540000000 + rng.randrange(86400),
+            })
+    return reserved
+
+
+def build_dicts(sheets, reserved):
+    detail = {rank: [] for rank, _, _ in RANKS}
+    for sheet in sheets:
+        detail[sheet['rank']].append(copy.copy(sheet))
+    for row in reserved:
+        sheet = sheets[row['sheet_id'] - 1]
+        entry = detail[sheet['rank']][sheet['num'] - 1]
+        if row['user_id'] == LOGIN_USER_ID:
+            entry['mine'] = True
+        entry['reserved'] = True
+        entry['reserved_at'] = row['reserved_at']
+    return {'sheets': {rank: {'detail': detail[rank]} for rank in detail}}
+
+
+def build_compact(catalog, reserved):
+    seats = eventdetail.EventSeats(catalog, LOGIN_USER_ID)
+    for row in reserved:
+        seats.reserve(row['sheet_id'], row['user_id'], row['reserved_at'])
+    return {'sheets': {rank: {'detail': seats.rank_detail(rank)} for rank, _, _ in RANKS}}
+
+
+def measure(fn):
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    sheets = make_sheets()
+    catalog = eventdetail.SheetCatalog(sheets)
+    for ratio in (0.0, 0.5, 1.0):
+        reserved = make_reserved(sheets, ratio)
+        old = json.dumps(build_dicts(sheets, reserved))
+        new = eventdetail.dumps(build_compact(catalog, reserved))
+        assert old == new
+
+        cases = [
+            ('dicts  ', lambda: build_dicts(sheets, reserved), json.dumps),
+            ('compact', lambda: build_compact(catalog, reserved), eventdetail.dumps),
+        ]
+        print('reserved {:3.0%}'.format(ratio))
+        for name, build, dumps in cases:
+            held = measure(build)
+            peak = measure(lambda: dumps(build()))
+            start = time.perf_counter()
+            for _ in range(100):
+                dumps(build())
+            elapsed = (time.perf_counter() - start) / 100
+            print('  {}: build peak {:8d} B, build+dumps peak {:8d} B, {:7.1f} us/event'.format(
+                name, held, peak, elapsed * 1e6))
+
+if __name__ == '__main__':
+    main()
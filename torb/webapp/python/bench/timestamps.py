@@ -0,0 +1,59 @@
+"""
+Microbenchmark for timeutil against the datetime-based formatting it replaces.
+
+    python3 -m bench.timestamps
+"""
+import random
+import timeit
+from datetime import datetime, timedelta, timezone
+
+import timeutil
+
+EPOCH = datetime(1970, 1, 1)
+N = 100000
+
+
+def make_samples(n):
+    rng = random.Random(0)
+    base = timeutil.now_usec()
+    samples = []
+    for _ in range(n):
+        usec = base + rng.randrange(0, 3600 * 1000000)
+        if rng.random() < 0.1:
+            usec -= usec % 1000000
+        samples.append(usec)
+    return samples
+
+
+def to_datetime(usec):
+    return EPOCH + timedelta(microseconds=usec)
+
+
+def check(samples):
+    for usec in samples:
+        dt = to_datetime(usec)
+        assert timeutil.to_epoch(usec) == int(dt.replace(tzinfo=timezone.utc).timestamp())
+        assert timeutil.to_iso(usec) == dt.isoformat() + "Z"
+        assert timeutil.to_sql(usec) == dt.strftime("%F %T.%f")
+
+
+def main():
+    samples = make_samples(N)
+    check(samples)
+    datetimes = [to_datetime(usec) for usec in samples]
+
+    cases = [
+        ("epoch   datetime", lambda: [int(dt.replace(tzinfo=timezone.utc).timestamp()) for dt in datetimes]),
+        ("epoch   timeutil", lambda: [timeutil.to_epoch(usec) for usec in samples]),
+        ("iso     datetime", lambda: [dt.isoformat() + "Z" for dt in datetimes]),
+        ("iso     timeutil", lambda: [timeutil.to_iso(usec) for usec in samples]),
+        ("sql now datetime", lambda: [datetime.utcnow().strftime("%F %T.%f") for _ in samples]),
+        ("sql now timeutil", lambda: [timeutil.to_sql(timeutil.now_usec()) for _ in samples]),
+    ]
+    for name, fn in cases:
+        best = min(timeit.repeat(fn, number=1, repeat=5))
+        print("{}: {:8.1f} ns/row".format(name, best / N * 1e9))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Credential verification for users and administrators.
+
+Passwords are hashed in the app (never with SHA2() on the DB), and only
+(id, pass_hash, nickname) is read, by a const lookup on the unique
+login_name key. Recently verified accounts are kept in a small LRU so that
+repeated logins do not need a DB round trip.
+
+/initialize resets the DB (and its auto-increment ids) but reaches only
+one worker, so clear() touches a generation file; every worker compares
+its mtime before trusting cached entries.
+"""
+import collections
+import hashlib
+import os
+import threading
+import time
+
+
+GENERATION_FILE = os.environ.get('CREDENTIALS_GENERATION_FILE', '/tmp/torb-credentials-generation')
+
+
+def hash_password(password):
+    return hashlib.sha256(password.encode('utf-8')).hexdigest()
+
+
+class CredentialCache:
+    """bounded LRU of login_name -> (id, pass_hash, nickname)
+
+    Entries are valid for one generation (see current_generation) and
+    expire after ttl seconds.
+    """
+
+    def __init__(self, maxsize=4096, ttl=60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._generation = None
+        self._lock = threading.Lock()
+
+    def get(self, login_name, generation):
+        with self._lock:
+            if generation != self._generation:
+                self._entries.clear()
+                self._generation = generation
+                return None
+            entry = self._entries.get(login_name)
+            if entry is None:
+                return None
+            expires_at, row = entry
+            if expires_at < time.monotonic():
+                del self._entries[login_name]
+                return None
+            self._entries.move_to_end(login_name)
+            return row
+
+    def put(self, login_name, row, generation):
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._entries[login_name] = (time.monotonic() + self.ttl, row)
+            self._entries.move_to_end(login_name)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+user_cache = CredentialCache()
+administrator_cache = CredentialCache(maxsize=64)
+
+
+def current_generation():
+    try:
+        return os.stat(GENERATION_FILE).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+
+def _verify(dbh, table, cache, login_name, password):
+    generation = current_generation()
+    row = cache.get(login_name, generation)
+    if row is None:
+        cur = dbh().cursor()
+        cur.execute(
+            "SELECT id, pass_hash, nickname FROM {} WHERE login_name = %s".format(table),
+            [login_name])
+        found = cur.fetchone()
+        if not found:
+            return None
+        row = (found['id'], found['pass_hash'], found['nickname'])
+    if hash_password(password) != row[1]:
+        return None
+    cache.put(login_name, row, generation)
+    return {'id': row[0], 'nickname': row[2], 'login_name': login_name, 'pass_hash': row[1]}
+
+
+def verify_user(dbh, login_name, password):
+    return _verify(dbh, 'users', user_cache, login_name, password)
+
+
+def verify_administrator(dbh, login_name, password):
+    return _verify(dbh, 'administrators', administrator_cache, login_name, password)
+
+
+def clear():
+    """invalidates cached credentials in every worker sharing GENERATION_FILE"""
+    previous = current_generation()
+    with open(GENERATION_FILE, 'a'):
+        pass
+    now = time.time_ns()
+    # the mtime must change even if the clock did not move since the last touch
+    os.utime(GENERATION_FILE, ns=(now, max(now, previous + 1)))
+    user_cache.clear()
+    administrator_cache.clear()
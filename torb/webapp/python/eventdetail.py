@@ -0,0 +1,123 @@
+"""
+Compact per-sheet state for get_event(with_detail=True).
+
+Instead of one dict per sheet, an event keeps flat arrays indexed by
+sheet id (reserved flag, owner, reserved_at), and each rank's "detail"
+is a RankDetail view over them. dumps() writes the views straight into
+the JSON output, using per-sheet strings precomputed in SheetCatalog,
+so the result is identical to serializing the old list of dicts.
+"""
+import json
+from array import array
+
+
+class SheetCatalog:
+    __slots__ = ('sheets', 'sheet_ids_by_rank', 'max_id', '_free', '_reserved_prefix', '_mine_prefix')
+
+    def __init__(self, sheets):
+        self.sheets = {}
+        self.sheet_ids_by_rank = {}
+        self.max_id = 0
+        self._free = {}
+        self._reserved_prefix = {}
+        self._mine_prefix = {}
+        for sheet in sheets:
+            sheet_id = sheet['id']
+            self.sheets[sheet_id] = sheet
+            self.sheet_ids_by_rank.setdefault(sheet['rank'], []).append(sheet_id)
+            self.max_id = max(self.max_id, sheet_id)
+            body = json.dumps(sheet)[:-1]
+            self._free[sheet_id] = body + '}'
+            self._reserved_prefix[sheet_id] = body + ', "reserved": true, "reserved_at": '
+            self._mine_prefix[sheet_id] = body + ', "mine": true, "reserved": true, "reserved_at": '
+
+
+class EventSeats:
+    __slots__ = ('catalog', 'login_user_id', 'reserved', 'owner', 'reserved_at')
+
+    def __init__(self, catalog, login_user_id=None):
+        size = catalog.max_id + 1
+        self.catalog = catalog
+        self.login_user_id = login_user_id
+        self.reserved = bytearray(size)
+        self.owner = array('L', [0]) * size
+        self.reserved_at = array('q', [0]) * size
+
+    def reserve(self, sheet_id, user_id, reserved_at):
+        self.reserved[sheet_id] = 1
+        self.owner[sheet_id] = user_id
+        self.reserved_at[sheet_id] = reserved_at
+
+    def is_mine(self, sheet_id):
+        return bool(self.login_user_id) and self.owner[sheet_id] == self.login_user_id
+
+    def rank_detail(self, rank):
+        return RankDetail(self, self.catalog.sheet_ids_by_rank.get(rank, []))
+
+
+class RankDetail:
+    __slots__ = ('seats', 'sheet_ids')
+
+    def __init__(self, seats, sheet_ids):
+        self.seats = seats
+        self.sheet_ids = sheet_ids
+
+    def to_json(self):
+        seats = self.seats
+        catalog = seats.catalog
+        parts = []
+        for sheet_id in self.sheet_ids:
+            if not seats.reserved[sheet_id]:
+                parts.append(catalog._free[sheet_id])
+            elif seats.is_mine(sheet_id):
+                parts.append(catalog._mine_prefix[sheet_id] + str(seats.reserved_at[sheet_id]) + '}')
+            else:
+                parts.append(catalog._reserved_prefix[sheet_id] + str(seats.reserved_at[sheet_id]) + '}')
+        return '[' + ', '.join(parts) + ']'
+
+    def to_list(self):
+        seats = self.seats
+        detail = []
+        for sheet_id in self.sheet_ids:
+            sheet = dict(seats.catalog.sheets[sheet_id])
+            if seats.reserved[sheet_id]:
+                if seats.is_mine(sheet_id):
+                    sheet['mine'] = True
+                sheet['reserved'] = True
+                sheet['reserved_at'] = seats.reserved_at[sheet_id]
+            detail.append(sheet)
+        return detail
+
+
+_PLACEHOLDER = '\ufffeRankDetail\ufffe'
+_ENCODED_PLACEHOLDER = json.dumps(_PLACEHOLDER)
+
+
+def _to_list(o):
+    if isinstance(o, RankDetail):
+        return o.to_list()
+    raise TypeError("Object of type {} is not JSON serializable".format(type(o).__name__))
+
+
+def dumps(target):
+    """json.dumps that writes RankDetail views without building per-sheet dicts"""
+    fragments = []
+
+    def default(o):
+        if isinstance(o, RankDetail):
+            fragments.append(o.to_json())
+            return _PLACEHOLDER
+        return _to_list(o)
+
+    encoded = json.dumps(target, default=default)
+    if not fragments:
+        return encoded
+    pieces = encoded.split(_ENCODED_PLACEHOLDER)
+    if len(pieces) != len(fragments) + 1:
+        # the placeholder also appeared in user data; take the slow path
+        return json.dumps(target, default=_to_list)
+    out = [pieces[0]]
+    for fragment, piece in zip(fragments, pieces[1:]):
+        out.append(fragment)
+        out.append(piece)
+    return ''.join(out)
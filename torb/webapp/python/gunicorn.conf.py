@@ -0,0 +1,8 @@
+import sys
+
+
+def post_worker_init(worker):
+    # runs after the worker has loaded the app and before it accepts requests
+    app = sys.modules.get('app')
+    if app is not None and hasattr(app, 'warm_up'):
+        app.warm_up()
@@ -0,0 +1,51 @@
+"""
+reserved_at / canceled_at handling without datetime objects.
+
+Timestamps are UTC DATETIME(6) in the DB and are fetched as integer
+microseconds since the epoch. Formatters cache the per-second part.
+"""
+import functools
+import time
+
+
+def usec_expr(column):
+    """a DATETIME(6) column as epoch microseconds (independent of time_zone)"""
+    return "TIMESTAMPDIFF(MICROSECOND, '1970-01-01 00:00:00', {})".format(column)
+
+
+def usec_column(column, alias):
+    """SELECT expression for usec_expr(column) named alias"""
+    return "{} AS {}".format(usec_expr(column), alias)
+
+
+def now_usec():
+    return time.time_ns() // 1000
+
+
+def to_epoch(usec):
+    """same as int(dt.replace(tzinfo=timezone.utc).timestamp())"""
+    return usec // 1000000
+
+
+@functools.lru_cache(maxsize=4096)
+def _iso_seconds(sec):
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(sec))
+
+
+@functools.lru_cache(maxsize=4096)
+def _sql_seconds(sec):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(sec))
+
+
+def to_iso(usec):
+    """same as dt.isoformat() + "Z" (fraction omitted when it is zero)"""
+    sec, frac = divmod(usec, 1000000)
+    if frac:
+        return _iso_seconds(sec) + ".%06dZ" % frac
+    return _iso_seconds(sec) + "Z"
+
+
+def to_sql(usec):
+    """same as dt.strftime("%F %T.%f")"""
+    sec, frac = divmod(usec, 1000000)
+    return _sql_seconds(sec) + ".%06d" % frac